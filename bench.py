@@ -0,0 +1,213 @@
+# benchmarks for the hot paths in textrogue
+# python bench.py --out now.json --baseline base.json --threshold 0.25
+
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+
+import textrogue as tr
+
+def newLevel(seed, depth=1, extra=0, monsters=True):
+    # fresh seeded game, generated at the given depth
+    tr.stressMonsters = extra
+    game = tr.Game(seed, brief=True)
+    if depth != 1:
+        tr.level = depth
+        tr.generateMap()
+    tr.stressMonsters = 0
+    if not monsters:
+        tr.Actor.reset([tr.player])
+        tr.startSchedule()
+    game.events()
+    return game
+
+def passableCells():
+    return [i for i in range(tr.mapw*tr.maph) \
+            if tr.tileFlags[tr.map[i]] & tr.tf_pass]
+
+def cellPairs(seed, n):
+    cells = passableCells()
+    r = random.Random(seed)
+    return [(r.choice(cells), r.choice(cells)) for i in range(n)]
+
+def benchGenerate(seed):
+    newLevel(seed)
+    t = time.perf_counter()
+    for i in range(20):
+        tr.generateMap()
+    return time.perf_counter()-t
+
+def benchPathMap(seed):
+    newLevel(seed)
+    pairs = cellPairs(seed, 50)
+    t = time.perf_counter()
+    for a, b in pairs:
+        tr.pathMap(tr.Actor.passable, b%tr.mapw, b//tr.mapw)
+    return time.perf_counter()-t
+
+def benchFindPath(seed):
+    newLevel(seed)
+    pairs = cellPairs(seed, 50)
+    t = time.perf_counter()
+    for a, b in pairs:
+        tr.findPath(tr.Actor.passable, a%tr.mapw, a//tr.mapw, \
+                    b%tr.mapw, b//tr.mapw, astar=True)
+    return time.perf_counter()-t
+
+def benchFov(seed):
+    newLevel(seed)
+    cells = passableCells()
+    tr.fovCache.clear()
+    t = time.perf_counter()
+    for i in cells:
+        tr.getFov(i%tr.mapw, i//tr.mapw)
+    return time.perf_counter()-t
+
+def benchSees(seed):
+    newLevel(seed)
+    cells = passableCells()[::4]
+    r = tr.sightDist
+    t = time.perf_counter()
+    for i in cells:
+        x = i%tr.mapw
+        y = i//tr.mapw
+        for yy in range(y-r, y+r+1):
+            for xx in range(x-r, x+r+1):
+                tr.sees(x, y, xx, yy)
+    return time.perf_counter()-t
+
+def benchDescribe(seed):
+    game = newLevel(seed)
+    cells = passableCells()[::8]
+    tr.quiet = False
+    t = time.perf_counter()
+    for i in cells:
+        tr.describe(i%tr.mapw, i//tr.mapw)
+    t = time.perf_counter()-t
+    tr.quiet = True
+    game.events()
+    return t
+
+def benchExplore(seed):
+    # explore the whole level without monsters in the way
+    game = newLevel(seed, monsters=False)
+    t = time.perf_counter()
+    stops = 0
+    for n in range(5000):
+        if tr.explore():
+            stops = 0
+            continue
+        # finding the exit stops explore once, a second stop is the end
+        stops += 1
+        if stops == 2:
+            break
+    t = time.perf_counter()-t
+    game.events()
+    return t
+
+def benchRest(seed):
+    game = newLevel(seed, monsters=False)
+    tr.player.mhp = 2000
+    tr.player.hp = 1
+    t = time.perf_counter()
+    tr.rest()
+    t = time.perf_counter()-t
+    game.events()
+    return t
+
+def benchCrowd(seed):
+    # a level 6 turn with every monster awake
+    game = newLevel(seed, depth=6, extra=300)
+    tr.player.mhp = tr.player.hp = 10**9
+    dormant = tr.dormantDist
+    tr.dormantDist = 0
+    t = time.perf_counter()
+    for i in range(50):
+        tr.update()
+    t = time.perf_counter()-t
+    tr.dormantDist = dormant
+    game.events()
+    return t
+
+benches = {
+    "generateMap": benchGenerate,
+    "pathMap": benchPathMap,
+    "findPath": benchFindPath,
+    "getFov": benchFov,
+    "sees": benchSees,
+    "describe": benchDescribe,
+    "explore": benchExplore,
+    "rest": benchRest,
+    "crowd": benchCrowd,
+}
+
+def run(names, seeds, repeat):
+    # best of repeat runs of each benchmark, summed over the seeds
+    results = {}
+    for name in names:
+        total = 0
+        for seed in seeds:
+            total += min([benches[name](seed) for i in range(repeat)])
+        results[name] = total
+    return results
+
+def compare(results, baseline, threshold):
+    # print the results next to the baseline, returns the names of the
+    # benchmarks that got slower by more than threshold
+    slower = []
+    for name, t in results.items():
+        base = baseline.get(name)
+        if base == None:
+            print("{:12} {:9.4f}s".format(name, t))
+            continue
+        ratio = t/base if base > 0 else 1
+        mark = ""
+        if ratio > 1+threshold:
+            mark = " SLOWER"
+            slower.append(name)
+        print("{:12} {:9.4f}s {:9.4f}s {:6.2f}x{}".format \
+              (name, t, base, ratio, mark))
+    return slower
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="textrogue benchmarks")
+    parser.add_argument("names", nargs="*", metavar="NAME",
+                        help="benchmarks to run, all by default: " + \
+                             ", ".join(benches))
+    parser.add_argument("--seeds", type=int, default=3, metavar="N",
+                        help="levels to run each benchmark on")
+    parser.add_argument("--repeat", type=int, default=3, metavar="N",
+                        help="runs per level, the best one counts")
+    parser.add_argument("--out", metavar="FILE",
+                        help="write the results to FILE as json")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare against results saved with --out")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="fail if a benchmark is this much slower than "
+                             "the baseline (0.25 is 25%%)")
+    args = parser.parse_args()
+    for name in args.names:
+        if not name in benches:
+            parser.error("unknown benchmark {}".format(name))
+    names = args.names if len(args.names) != 0 else list(benches)
+    baseline = {}
+    if args.baseline != None:
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        if saved["seeds"] != args.seeds:
+            parser.error("the baseline was run with --seeds {}".format \
+                         (saved["seeds"]))
+        baseline = saved["results"]
+    results = run(names, range(args.seeds), args.repeat)
+    slower = compare(results, baseline, args.threshold)
+    if args.out != None:
+        with open(args.out, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "numpy": tr.useNumpy, "seeds": args.seeds,
+                       "results": results}, f, indent=1)
+    if len(slower) != 0:
+        print("slower than the baseline: {}".format(", ".join(slower)))
+        sys.exit(1)
@@ -1,37 +1,138 @@
 # simple text-based roguelike
 # tdwsl 2023
 
+import os
+import sys
+import time
+import json
+import atexit
+import mmap
+import struct
+import shutil
+import tempfile
+import argparse
+import functools
 import random
 import math
+from collections import deque, OrderedDict
+from heapq import heappush, heappop
+from bisect import bisect_left
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 mapw = 50
 maph = 30
-map = []
-explored = []
+# map and explored are bytearrays of mapw*maph cells, so numpy can work on
+# them in place when it is installed
+map = bytearray()
+explored = bytearray()
+useNumpy = numpy != None
+# bookkeeping kept up to date by updateExplored, see indexExplored
+unexploredCount = 0
+knownTiles = {}
+frontier = set()
+# connected area of each passable cell (-1 otherwise) and the number of
+# unexplored cells in each area
+areaMap = []
+areaUnexplored = []
+# route explore() is following, see explore
+explorePlan = None
 player = 0
 level = 1
 turn = 0
+chaseMap = None
+mapVersion = 0
+# where the current game gets its random numbers, every game has its own
+# stream started from its seed
+rng = random
+# text said so far in the current step, see say
+output = []
+# set while the game waits for a y/N answer to this question
+asking = None
+# how the game ended: "dead", "left" or "quit", None while it goes on
+ending = None
+# turns played over every level, turn starts over on each level
+totalTurns = 0
+# leave out describe's report of the surroundings, for batch runs
+quiet = False
+# total turn a replay stops at, explore, rest and go give up there, -1 for
+# no stop
+stopTurn = -1
+# extra monsters spread over the rooms of every level, for stress testing
+# (pair it with a bigger mapw and maph for thousands of them, see mapSize)
+stressMonsters = 0
+# levels the player left are kept as snapshots, the least recently left
+# ones past levelCacheSize are written out to files in levelDir
+levelCacheSize = 8
+levels = None
+levelDir = None
+levelFiles = {}
+# loaded save file and where the levels not yet visited since are in it,
+# see loadGame
+saveMap = None
+savedLevels = {}
+# file the game is saved to on every change of level
+autosave = None
 
 dirs = [[0,-1], [1,0], [0,1], [-1,0]]
 dirLetters = ["N", "E", "S", "W"]
 dirNames = ["north", "east", "south", "west", "somewhere"]
 
 sightDist = 5
+# getFov uses shadowcasting, set exactFov to check every cell in range
+# with sees() instead, the same line of sight monsters use
+# everything the player is told about or stopped by goes by getFov, see
+# inView, while monsters look for the player with sees()
+exactFov = False
+# monsters further than dormantDist cells from the player on either axis
+# stop taking turns until the player comes back in range, 0 keeps every
+# monster awake
+dormantDist = 12
+# most wander steps a monster catches up on when it wakes
+catchUpSteps = 40
+
+# tile registry filled in by addTile: the character and name of every
+# tile type, and its tf_ flags in tileFlags so hot paths can test a tile
+# with a single index
+tileChars = []
+tileNames = []
+tileFlags = bytearray(256)
+# actors can walk on it
+tf_pass = 1
+# blocks line of sight
+tf_opaque = 2
+# part of a room, see roomSize and regionKind
+tf_room = 4
+# worth pointing out, describe lists these and knownTiles tracks them
+tf_mark = 8
+
+def addTile(char, name, flags):
+    t = len(tileChars)
+    tileChars.append(char)
+    tileNames.append(name)
+    tileFlags[t] = flags
+    return t
+
+def tilesWith(flag):
+    return [t for t in range(len(tileChars)) if tileFlags[t] & flag]
 
-tl_rock = 0
-tl_wall = 1
-tl_room = 2
-tl_door = 3
-tl_path = 4
-tl_temp = 5
-tl_up = 6
-tl_down = 7
-tl_oob = 20
-tl_blocked = 20
-tl_tdoor = 20
-
-tileChars = [" ", "#", ".", "+", "-", "T", "<", ">"]
-tileNames = ["r", "w", "rm", "a door", "p", "t", "the entrance", "the exit"]
+tl_rock = addTile(" ", "r", tf_opaque)
+tl_wall = addTile("#", "w", tf_opaque)
+tl_room = addTile(".", "rm", tf_pass|tf_room)
+tl_door = addTile("+", "a door", tf_pass|tf_opaque|tf_mark)
+tl_path = addTile("-", "p", tf_pass)
+tl_temp = addTile("T", "t", 0)
+tl_up = addTile("<", "the entrance", tf_pass|tf_room|tf_mark)
+tl_down = addTile(">", "the exit", tf_pass|tf_room|tf_mark)
+# door spots left on room walls during generation, most become rock
+tl_tdoor = addTile("+", "d", 0)
+# what getTile returns off the map
+tl_oob = addTile(" ", "o", tf_opaque)
 
 def inBounds(x, y):
     return x >= 0 and y >= 0 and x < mapw and y < maph
@@ -41,36 +142,144 @@ def getTile(x, y):
         return map[y*mapw+x]
     return tl_oob
 
+def gridView(buf):
+    # numpy array sharing memory with a bytearray grid such as map
+    return numpy.frombuffer(buf, dtype=numpy.uint8)
+
+def tileMask(flag):
+    # numpy lookup table that is True for tile types with the given flag,
+    # index it with gridView(map) to get a mask over the map
+    return numpy.frombuffer(tileFlags, dtype=numpy.uint8) & flag != 0
+
+allowedTables = {}
+
+def allowedTable(allowed):
+    # lookup table like tileFlags that is 1 for the tile types in allowed
+    key = tuple(allowed)
+    table = allowedTables.get(key)
+    if table == None:
+        table = bytearray(256)
+        for t in allowed:
+            table[t] = 1
+        allowedTables[key] = table
+    return table
+
 def setTile(x, y, t):
     if inBounds(x, y):
         map[y*mapw+x] = t
+        mapChanged()
 
-def pathMap(allowed, x2, y2):
-    pmap = []
-    for i in range(mapw*maph):
-        pmap.append(0 if map[i] in allowed else -1)
+def mapChanged():
+    # any write to map has to bump the version so cached results based on
+    # the old tiles stop being used
+    global mapVersion
+    mapVersion += 1
+
+class Cache:
+    # small lru cache, the least recently used entry is dropped once there
+    # are more than size entries
+    # evicted(key, v) is called for each entry that is dropped
+    def __init__(self, size, evicted=None):
+        self.size = size
+        self.evicted = evicted
+        self.items = OrderedDict()
+
+    def get(self, key):
+        v = self.items.get(key)
+        if v != None:
+            self.items.move_to_end(key)
+        return v
+
+    def put(self, key, v):
+        self.items[key] = v
+        self.items.move_to_end(key)
+        while len(self.items) > self.size:
+            k, old = self.items.popitem(last=False)
+            if self.evicted != None:
+                self.evicted(k, old)
+
+    def pop(self, key):
+        return self.items.pop(key, None)
+
+    def clear(self):
+        self.items.clear()
+
+def pathMap(allowed, x2, y2, x1=-1, y1=-1, blocked=()):
+    # breadth-first flood from x2,y2, each cell is visited once
+    # if x1,y1 is given, stop as soon as that cell has been reached
+    # cells listed in blocked are treated as impassable
+    ok = allowedTable(allowed)
+    pmap = [0 if ok[t] else -1 for t in map]
+    for i in blocked:
+        pmap[i] = -1
     pmap[y2*mapw+x2] = 1
-    g = 0
-    while True:
-        g += 1
-        nutin = True
-        for i in range(mapw*maph):
-            if pmap[i] == g:
-                nutin = False
-                for d in dirs:
-                    x = i%mapw + d[0]
-                    y = i//mapw + d[1]
-                    if inBounds(x, y):
-                       if pmap[y*mapw+x] == 0:
-                           pmap[y*mapw+x] = g+1
-        if nutin:
+    stop = y1*mapw+x1 if inBounds(x1, y1) else -1
+    if stop == y2*mapw+x2:
+        return pmap
+    queue = deque([y2*mapw+x2])
+    while queue:
+        i = queue.popleft()
+        g = pmap[i]+1
+        x = i%mapw
+        for n in (i-mapw if i >= mapw else -1, \
+                  i+1 if x < mapw-1 else -1, \
+                  i+mapw if i < mapw*(maph-1) else -1, \
+                  i-1 if x > 0 else -1):
+            if n != -1 and pmap[n] == 0:
+                pmap[n] = g
+                if n == stop:
+                    return pmap
+                queue.append(n)
+    return pmap
+
+def astarMap(allowed, x1, y1, x2, y2, blocked=()):
+    # a* from x2,y2 towards x1,y1 with a manhattan heuristic
+    # the search carries on until every cell that could lie on a shortest
+    # path is settled, so findPath walks the same steps as with pathMap
+    # cells in blocked are treated as impassable
+    ok = allowedTable(allowed)
+    pmap = [0]*(mapw*maph)
+    start = y1*mapw+x1
+    goal = y2*mapw+x2
+    best = {goal: 1}
+    heap = [(abs(x2-x1)+abs(y2-y1)+1, goal)]
+    limit = -1
+    while heap:
+        f, i = heappop(heap)
+        if limit != -1 and f > limit:
             break
+        if pmap[i] != 0:
+            continue
+        g = best[i]
+        pmap[i] = g
+        if i == start:
+            limit = f
+        x = i%mapw
+        for n in (i-mapw if i >= mapw else -1, \
+                  i+1 if x < mapw-1 else -1, \
+                  i+mapw if i < mapw*(maph-1) else -1, \
+                  i-1 if x > 0 else -1):
+            if n != -1 and pmap[n] == 0 and ok[map[n]] \
+                    and not n in blocked:
+                if g+1 < best.get(n, g+2):
+                    best[n] = g+1
+                    h = abs(n%mapw-x1)+abs(n//mapw-y1)
+                    heappush(heap, (g+1+h, n))
     return pmap
 
-def findPath(allowed, x1, y1, x2, y2):
-    if not map[y1*mapw+x1] in allowed or not map[y2*mapw+x2] in allowed:
+def findPath(allowed, x1, y1, x2, y2, astar=False, blocked=()):
+    # cells in blocked, other than the two ends, are treated as impassable
+    ok = allowedTable(allowed)
+    if not ok[map[y1*mapw+x1]] or not ok[map[y2*mapw+x2]]:
         return []
-    pmap = pathMap(allowed, x2, y2)
+    if len(blocked) != 0:
+        blocked = set(blocked)
+        blocked.discard(y1*mapw+x1)
+        blocked.discard(y2*mapw+x2)
+    if astar:
+        pmap = astarMap(allowed, x1, y1, x2, y2, blocked)
+    else:
+        pmap = pathMap(allowed, x2, y2, x1, y1, blocked)
     if pmap[y1*mapw+x1] == 0:
         return []
     x = x1
@@ -88,47 +297,434 @@ def findPath(allowed, x1, y1, x2, y2):
         path.append([x, y])
     return path
 
+# abstract graph over the level for long searches, built by buildRegions
+# regionMap gives the region of each passable cell (-1 otherwise): a room,
+# a door, a corridor junction or a stretch of corridor between junctions
+# portals are the cells of a region that border another region
+regionMap = []
+regionPortals = []
+# bounding box of each region as [x, y, w, h], and whether the region fills
+# it, in which case distances inside it are just manhattan distances
+regionBox = []
+regionRect = []
+# for each portal of a region that isn't a rectangle, distances to the
+# cells of its region without leaving it
+portalDist = {}
+# for each portal, the portals of other regions right next to it
+portalLinks = {}
+# kind of each region, as given by regionKind
+regionKinds = []
+# directions with more corridor for every dead end, turn and fork
+corridorNodes = {}
+regionVersion = -1
+
+def regionKind(i):
+    # 0 for room cells, 1 for corridors, 2 for junctions and 3 for doors,
+    # -1 for anything impassable
+    t = map[i]
+    if tileFlags[t] & tf_room:
+        return 0
+    if t == tl_door:
+        return 3
+    if t != tl_path:
+        return -1
+    forks = 0
+    for n in neighbours(i):
+        if map[n] == tl_path:
+            forks += 1
+    return 2 if forks > 2 else 1
+
+def regionSearch(i):
+    # breadth-first search from i that stays inside i's region
+    r = regionMap[i]
+    dist = {i: 0}
+    queue = deque([i])
+    while queue:
+        j = queue.popleft()
+        for n in neighbours(j):
+            if regionMap[n] == r and not n in dist:
+                dist[n] = dist[j]+1
+                queue.append(n)
+    return dist
+
+def regionStep(p, i):
+    # distance from portal p to cell i of the same region, inside it
+    if regionRect[regionMap[i]]:
+        return abs(p%mapw-i%mapw)+abs(p//mapw-i//mapw)
+    return portalDist[p][i]
+
+def buildRegions():
+    global regionMap
+    global regionPortals
+    global regionBox
+    global regionRect
+    global portalDist
+    global portalLinks
+    global regionKinds
+    global corridorNodes
+    global regionVersion
+    kinds = [regionKind(i) for i in range(mapw*maph)]
+    regionMap = [-1]*(mapw*maph)
+    regionPortals = []
+    regionBox = []
+    regionRect = []
+    regionKinds = []
+    for i in range(mapw*maph):
+        if kinds[i] == -1 or regionMap[i] != -1:
+            continue
+        r = len(regionPortals)
+        regionPortals.append([])
+        regionKinds.append(kinds[i])
+        regionMap[i] = r
+        cells = [i]
+        queue = [i]
+        while queue and kinds[i] < 2:
+            j = queue.pop()
+            for n in neighbours(j):
+                if regionMap[n] == -1 and kinds[n] == kinds[i]:
+                    regionMap[n] = r
+                    cells.append(n)
+                    queue.append(n)
+        xs = [j%mapw for j in cells]
+        ys = [j//mapw for j in cells]
+        box = [min(xs), min(ys), max(xs)-min(xs)+1, max(ys)-min(ys)+1]
+        regionBox.append(box)
+        regionRect.append(len(cells) == box[2]*box[3])
+    portalDist = {}
+    portalLinks = {}
+    for i in range(mapw*maph):
+        r = regionMap[i]
+        if r == -1:
+            continue
+        links = []
+        for n in neighbours(i):
+            if regionMap[n] != -1 and regionMap[n] != r:
+                links.append(n)
+        if len(links) != 0:
+            regionPortals[r].append(i)
+            portalLinks[i] = links
+            if not regionRect[r]:
+                portalDist[i] = regionSearch(i)
+    corridorNodes = {}
+    for i in range(mapw*maph):
+        if map[i] != tl_path:
+            continue
+        fork = []
+        other = 0
+        for di in range(len(dirs)):
+            t = getTile(i%mapw+dirs[di][0], i//mapw+dirs[di][1])
+            if t == tl_path:
+                fork.append(di)
+            elif tileFlags[t] & tf_pass:
+                other += 1
+        if len(fork) == 1 and other == 0:
+            corridorNodes[i] = fork
+        elif len(fork) == 2 and fork[1]-fork[0] != 2:
+            corridorNodes[i] = fork
+        elif len(fork) > 2:
+            corridorNodes[i] = fork
+    regionVersion = mapVersion
+
+# region fields by cell and map version, the goals of go and the cells it
+# is asked from keep coming back until the map changes
+fieldCacheSize = 16
+fieldCache = Cache(fieldCacheSize)
+
+def regionField(i):
+    # distances from cell i to the portals it can reach, worked out over the
+    # region graph, as [i, distances inside i's region or None, distances to
+    # portals]
+    # fields are remembered until the map changes, so they are shared and
+    # must not be modified
+    if regionVersion != mapVersion:
+        buildRegions()
+    key = (i, mapVersion)
+    field = fieldCache.get(key)
+    if field != None:
+        return field
+    field = [i, None, {}]
+    if not regionRect[regionMap[i]]:
+        field[1] = regionSearch(i)
+    dist = field[2]
+    heap = []
+    for q in regionPortals[regionMap[i]]:
+        heappush(heap, (regionStep(q, i), q))
+    while heap:
+        d, q = heappop(heap)
+        if q in dist:
+            continue
+        dist[q] = d
+        for p in regionPortals[regionMap[q]]:
+            if not p in dist:
+                heappush(heap, (d+regionStep(p, q), p))
+        for p in portalLinks[q]:
+            if not p in dist:
+                heappush(heap, (d+1, p))
+    fieldCache.put(key, field)
+    return field
+
+def fieldDist(field, i):
+    # distance to cell i from the cell field was made for, -1 if there is
+    # no way there
+    o, local, dist = field
+    r = regionMap[i]
+    best = -1
+    if r == -1:
+        return best
+    if r == regionMap[o]:
+        if local == None:
+            best = abs(o%mapw-i%mapw)+abs(o//mapw-i//mapw)
+        else:
+            best = local[i]
+    for q in regionPortals[r]:
+        if q in dist:
+            d = dist[q]+regionStep(q, i)
+            if best == -1 or d < best:
+                best = d
+    return best
+
+def regionPath(x1, y1, x2, y2):
+    # same path as findPath(Actor.passable, ...), but distances come from the
+    # region graph rather than from a search over the cells
+    if not tileFlags[map[y1*mapw+x1]] & tf_pass:
+        return []
+    if not tileFlags[map[y2*mapw+x2]] & tf_pass:
+        return []
+    field = regionField(y2*mapw+x2)
+    g = fieldDist(field, y1*mapw+x1)
+    if g == -1:
+        return []
+    known = {}
+    x = x1
+    y = y1
+    path = []
+    while g > 0:
+        for d in dirs:
+            dx = x+d[0]
+            dy = y+d[1]
+            if not inBounds(dx, dy):
+                continue
+            i = dy*mapw+dx
+            if not i in known:
+                known[i] = fieldDist(field, i)
+            if known[i] == g-1:
+                x = dx
+                y = dy
+                g -= 1
+                break
+        path.append([x, y])
+    return path
+
+# cells crossed by the line of sight to each dx,dy within sightDist, as
+# offsets into map, built by buildRays and rebuilt if sightDist changes
+rays = []
+rayKey = None
+
+def buildRays():
+    global rays
+    global rayKey
+    r = sightDist
+    rays = []
+    for yd in range(-r, r+1):
+        for xd in range(-r, r+1):
+            if xd*xd+yd*yd > r*r or (xd == 0 and yd == 0):
+                rays.append(None)
+                continue
+            m = max(abs(xd), abs(yd))
+            ray = []
+            for i in range(1, m):
+                x = math.floor((xd*i)/m+0.5)
+                y = math.floor((yd*i)/m+0.5)
+                ray.append(y*mapw+x)
+            rays.append(tuple(ray))
+    rayKey = (sightDist, mapw)
+
 def sees(x1, y1, x2, y2):
     if x1 == x2 and y1 == y2:
         return True
+    if rayKey != (sightDist, mapw):
+        buildRays()
     xd = x2-x1
     yd = y2-y1
-    if xd*xd+yd*yd > sightDist*sightDist:
+    if abs(xd) > sightDist or abs(yd) > sightDist or not inBounds(x2, y2):
         return False
-    m = 0
-    if abs(xd) > abs(yd):
-        m = abs(xd)
-    else:
-        m = abs(yd)
-    for i in range(1, m+1):
-        x = math.floor(x1+(xd*i)/m+0.5)
-        y = math.floor(y1+(yd*i)/m+0.5)
-        if x == x1 and y == y1:
-            continue
-        if not inBounds(x, y):
+    ray = rays[(yd+sightDist)*(sightDist*2+1)+xd+sightDist]
+    if ray == None:
+        return False
+    i = y1*mapw+x1
+    for d in ray:
+        if tileFlags[map[i+d]] & tf_opaque:
             return False
-        if x == x2 and y == y2:
+    return True
+
+# xx, xy, yx, yy for each of the eight octants
+octants = [
+    [1, 0, 0, 1], [0, 1, 1, 0], [0, -1, 1, 0], [-1, 0, 0, 1],
+    [-1, 0, 0, -1], [0, -1, -1, 0], [0, 1, -1, 0], [1, 0, 0, -1],
+]
+
+def opaque(x, y):
+    return tileFlags[getTile(x, y)] & tf_opaque != 0
+
+def castLight(vis, cx, cy, row, start, end, oct):
+    # recursive shadowcasting over one octant, start and end are slopes
+    if start < end:
+        return
+    xx, xy, yx, yy = oct
+    r2 = sightDist*sightDist
+    newStart = 0
+    for j in range(row, sightDist+1):
+        dx = -j-1
+        dy = -j
+        blocked = False
+        while dx <= 0:
+            dx += 1
+            x = cx + dx*xx + dy*xy
+            y = cy + dx*yx + dy*yy
+            ls = (dx-0.5)/(dy+0.5)
+            rs = (dx+0.5)/(dy-0.5)
+            if start < rs:
+                continue
+            elif end > ls:
+                break
+            if dx*dx+dy*dy <= r2 and inBounds(x, y):
+                vis.add(y*mapw+x)
+            if blocked:
+                if opaque(x, y):
+                    newStart = rs
+                else:
+                    blocked = False
+                    start = newStart
+            elif opaque(x, y) and j < sightDist:
+                blocked = True
+                castLight(vis, cx, cy, j+1, start, ls, oct)
+                newStart = rs
+        if blocked:
+            break
+
+# visible cells by viewer position and map version, see getFov
+fovCache = Cache(256)
+
+def getFov(x, y):
+    # sorted indices of the cells visible from x,y, packed into an array
+    # results are remembered until the map changes, so the array is shared
+    # and must not be modified
+    key = (y*mapw+x, mapVersion, sightDist, exactFov)
+    fov = fovCache.get(key)
+    if fov == None:
+        fov = array("H" if mapw*maph <= 0x10000 else "I", castFov(x, y))
+        fovCache.put(key, fov)
+    return fov
+
+def inView(x, y):
+    # whether the player sees x,y, by the same fov describe reports from
+    fov = getFov(player.x, player.y)
+    i = y*mapw+x
+    j = bisect_left(fov, i)
+    return j < len(fov) and fov[j] == i
+
+def castFov(x, y):
+    # only the box within sightDist of x,y is looked at
+    if exactFov:
+        fov = []
+        for yy in range(max(y-sightDist, 0), min(y+sightDist+1, maph)):
+            for xx in range(max(x-sightDist, 0), min(x+sightDist+1, mapw)):
+                if sees(x, y, xx, yy):
+                    fov.append(yy*mapw+xx)
+        return fov
+    vis = set([y*mapw+x])
+    for oct in octants:
+        castLight(vis, x, y, 1, 1.0, 0.0, oct)
+    return sorted(vis)
+
+def neighbours(i):
+    x = i%mapw
+    n = []
+    if i >= mapw:
+        n.append(i-mapw)
+    if x < mapw-1:
+        n.append(i+1)
+    if i < mapw*(maph-1):
+        n.append(i+mapw)
+    if x > 0:
+        n.append(i-1)
+    return n
+
+def onFrontier(i):
+    # explored passable cell next to an unexplored one
+    if not explored[i] or not tileFlags[map[i]] & tf_pass:
+        return False
+    for n in neighbours(i):
+        if not explored[n]:
             return True
-        if map[y*mapw+x] in [tl_door, tl_wall, tl_rock]:
-            return False
     return False
 
-def getFov(x, y):
-    fov = []
+def indexExplored():
+    # work out the bookkeeping updateExplored keeps from scratch
+    # knownTiles holds the explored doors and stairs, frontier the explored
+    # cells that border unexplored ones
+    global unexploredCount
+    global knownTiles
+    global frontier
+    global areaMap
+    global areaUnexplored
+    areaMap = [-1]*(mapw*maph)
+    areaUnexplored = []
     for i in range(mapw*maph):
-        fov.append(sees(x, y, i%mapw, i//mapw))
-    return fov
+        if areaMap[i] != -1 or not tileFlags[map[i]] & tf_pass:
+            continue
+        a = len(areaUnexplored)
+        areaUnexplored.append(0)
+        areaMap[i] = a
+        queue = [i]
+        while queue:
+            j = queue.pop()
+            if not explored[j]:
+                areaUnexplored[a] += 1
+            for n in neighbours(j):
+                if areaMap[n] == -1 and tileFlags[map[n]] & tf_pass:
+                    areaMap[n] = a
+                    queue.append(n)
+    unexploredCount = explored.count(0)
+    knownTiles = {t: set() for t in tilesWith(tf_mark)}
+    frontier = set()
+    for i in range(mapw*maph):
+        if explored[i] and map[i] in knownTiles:
+            knownTiles[map[i]].add(i)
+        if onFrontier(i):
+            frontier.add(i)
 
 def updateExplored(fov):
-    for i in range(mapw*maph):
-        if fov[i]:
-            explored[i] = True
+    global unexploredCount
+    for i in fov:
+        if explored[i]:
+            continue
+        explored[i] = True
+        unexploredCount -= 1
+        areaUnexplored[areaMap[i]] -= 1
+        if map[i] in knownTiles:
+            knownTiles[map[i]].add(i)
+        if onFrontier(i):
+            frontier.add(i)
+        for n in neighbours(i):
+            if n in frontier and not onFrontier(n):
+                frontier.remove(n)
 
 class Actor:
     actors = []
-    passable = [tl_door, tl_path, tl_room, tl_up, tl_down]
+    passable = tilesWith(tf_pass)
+    nextId = 0
+    __slots__ = ["id", "x", "y", "name", "hp", "mhp", "mp", "mmp", "str",
+                 "lvl", "xp", "mxp", "dead", "speed", "sleep", "gen"]
+    # living actors by map index, in order of creation
+    cells = {}
+    # all actors, dead ones included, by bucketSize square
+    buckets = {}
+    bucketSize = 8
 
-    def __init__(self, x=0, y=0, hp=5, mp=0, name="actor"):
+    def __init__(self, x=0, y=0, hp=5, mp=0, name="actor", str=0, lvl=0):
+        self.id = Actor.nextId
+        Actor.nextId += 1
         self.x = x
         self.y = y
         self.name = name
@@ -136,95 +732,174 @@ class Actor:
         self.mhp = hp
         self.mp = mp
         self.mmp = mp
-        self.lvl = 0
+        self.str = str
+        self.lvl = lvl
         self.xp = 0
         self.mxp = 0
         self.dead = False
-        self.under = tl_room
+        # 100 is one action a turn, 200 two and 50 one every other turn
+        self.speed = 100
+        # turn the actor went dormant, -1 while awake
+        self.sleep = -1
+        # bumped by scheduleActor, events from older schedules are stale
+        self.gen = 0
         Actor.actors.append(self)
+        self.index()
 
-    def calcStr(self, a):
-        return self.str - a.str//4
+    def reset(actors):
+        # start over with just the given actors, e.g. for a new level
+        Actor.actors = []
+        Actor.cells = {}
+        Actor.buckets = {}
+        for a in actors:
+            Actor.actors.append(a)
+            a.index()
 
-    def block(self):
+    def index(self):
         if not self.dead:
-            self.under = map[self.y*mapw+self.x]
-            map[self.y*mapw+self.x] = tl_blocked
+            l = Actor.cells.setdefault(self.y*mapw+self.x, [])
+            i = len(l)
+            while i > 0 and l[i-1].id > self.id:
+                i -= 1
+            l.insert(i, self)
+        b = (self.x//Actor.bucketSize, self.y//Actor.bucketSize)
+        Actor.buckets.setdefault(b, []).append(self)
 
-    def unblock(self):
+    def unindex(self):
         if not self.dead:
-            map[self.y*mapw+self.x] = self.under
+            i = self.y*mapw+self.x
+            Actor.cells[i].remove(self)
+            if len(Actor.cells[i]) == 0:
+                del Actor.cells[i]
+        b = (self.x//Actor.bucketSize, self.y//Actor.bucketSize)
+        Actor.buckets[b].remove(self)
+        if len(Actor.buckets[b]) == 0:
+            del Actor.buckets[b]
+
+    def setPos(self, x, y):
+        self.unindex()
+        self.x = x
+        self.y = y
+        self.index()
+
+    def die(self):
+        self.unindex()
+        self.dead = True
+        self.index()
+
+    def near(x, y, r):
+        # actors, dead ones included, no more than r cells away on either
+        # axis, in order of creation
+        found = []
+        bs = Actor.bucketSize
+        for by in range((y-r)//bs, (y+r)//bs+1):
+            for bx in range((x-r)//bs, (x+r)//bs+1):
+                for a in Actor.buckets.get((bx, by), ()):
+                    if abs(a.x-x) <= r and abs(a.y-y) <= r:
+                        found.append(a)
+        found.sort(key=lambda a: a.id)
+        return found
+
+    def calcStr(self, a):
+        return self.str - a.str//4
 
     def meleeAttack(self, a):
-        visible = sees(player.x, player.y, self.x, self.y)
+        visible = inView(self.x, self.y)
         str = self.calcStr(a)
         a.hp -= str
         if visible:
-            print("{} attacks {} for {} damage.".format \
+            say("{} attacks {} for {} damage.".format \
                   (self.name, a.name, str))
         if a.hp <= 0:
             if visible:
-                print("{} dies!".format(a.name))
-            a.dead = True
+                say("{} dies!".format(a.name))
+            a.die()
             self.xp += a.lvl
 
     def actorAt(x, y):
-        for a in Actor.actors:
-            if a.x == x and a.y == y and not a.dead:
-                return a
-        return False
+        if not inBounds(x, y):
+            return False
+        l = Actor.cells.get(y*mapw+x)
+        if l == None:
+            return False
+        return l[0]
 
     def move(self, x, y):
         if self.dead:
             return 0
         if x == self.x and y == self.y:
             return 1
-        if not getTile(x, y) in Actor.passable:
+        if not tileFlags[getTile(x, y)] & tf_pass:
             return 0
         a = Actor.actorAt(x, y)
         if a != False:
             self.meleeAttack(a)
             return 2
-        self.x = x
-        self.y = y
+        self.setPos(x, y)
         return 1
 
     def wander(self):
         mdirs = dirs.copy()
-        random.shuffle(mdirs)
+        rng.shuffle(mdirs)
         for d in mdirs:
-            if Actor.actorAt(self.x+d[0], self.y+d[1]) == False:
-                if getTile(self.x+d[0], self.y+d[1]) in Actor.passable:
-                    self.x += d[0]
-                    self.y += d[1]
-                    return
+            x = self.x+d[0]
+            y = self.y+d[1]
+            if not inBounds(x, y):
+                continue
+            i = y*mapw+x
+            if not i in Actor.cells and tileFlags[map[i]] & tf_pass:
+                self.setPos(x, y)
+                return
 
-    def update(self):
-        if turn % 12 == 0 and not self.dead and self.mp < self.mmp:
-            self.mp += 1
-        if turn % 8 == 0 and not self.dead and self.hp < self.mhp:
-            self.hp += 1
+    def wake(self):
+        # catch up on the turns missed while dormant: wander in bulk and
+        # add whatever would have regenerated
+        t = self.sleep
+        self.sleep = -1
+        steps = (turn-t)*self.speed//100
+        for n in range(min(steps, catchUpSteps)):
+            self.wander()
+        if self.mp < self.mmp:
+            self.mp = min(self.mmp, self.mp+(turn-1)//mpRegen-t//mpRegen)
+        if self.hp < self.mhp:
+            self.hp = min(self.mhp, self.hp+(turn-1)//hpRegen-t//hpRegen)
+        scheduleActor(self)
 
     def enemyUpdate(self):
         if self.dead:
             return
         if sees(self.x, self.y, player.x, player.y):
-            self.approach(player.x, player.y)
+            self.chase()
         else:
             self.wander()
 
-    def approach(self, x, y):
-        for a in Actor.actors:
-            a.block()
-        a = Actor.actorAt(x, y)
-        if a != False:
-            a.unblock()
-        self.unblock()
-        p = findPath(Actor.passable, self.x, self.y, x, y)
-        if len(p) != 0:
-            self.move(p[0][0], p[0][1])
-        for a in Actor.actors:
-            a.unblock()
+    def chase(self):
+        # step along the distance field to the player, which is shared by
+        # every chaser this turn
+        # occupied cells are blocked out of the field, so a chaser reads its
+        # own distance off its neighbours and skips cells that have been
+        # taken since
+        global chaseMap
+        if chaseMap == None:
+            chaseMap = pathMap(Actor.passable, player.x, player.y, \
+                               blocked=Actor.cells)
+        g = 0
+        for d in dirs:
+            x = self.x+d[0]
+            y = self.y+d[1]
+            if inBounds(x, y) and chaseMap[y*mapw+x] > 0:
+                if g == 0 or chaseMap[y*mapw+x] < g:
+                    g = chaseMap[y*mapw+x]
+        if g == 0:
+            return
+        for d in dirs:
+            x = self.x+d[0]
+            y = self.y+d[1]
+            if inBounds(x, y) and chaseMap[y*mapw+x] == g:
+                a = Actor.actorAt(x, y)
+                if a == False or a == player:
+                    self.move(x, y)
+                    return
 
     def moveAlert(self, x, y):
         d = [x-self.x, y-self.y]
@@ -235,9 +910,9 @@ class Actor:
                 if dirs[i][0] == d[0] and dirs[i][1] == d[1]:
                     di = i
                     break
-            print("You move {}.".format(dirNames[di]))
+            say("You move {}.".format(dirNames[di]))
         elif m == 0:
-            print("You can't go that way.")
+            say("You can't go that way.")
             return False
         return True
 
@@ -246,13 +921,13 @@ def connectRooms(rooms):
         r1 = rooms[i]
         r2 = rooms[i+1]
         path = findPath([tl_door, tl_tdoor, tl_room, tl_path, tl_rock], \
-                        r1[0], r1[1], r2[0], r2[1])
+                        r1[0], r1[1], r2[0], r2[1], astar=True)
         for p in path:
             t = map[p[1]*mapw+p[0]]
             if t == tl_rock:
-                map[p[1]*mapw+p[0]] = tl_path
+                setTile(p[0], p[1], tl_path)
             elif t == tl_tdoor:
-                map[p[1]*mapw+p[0]] = tl_door
+                setTile(p[0], p[1], tl_door)
         for i in range(len(path)):
             p = path[i]
             if i % 3 != 0:
@@ -308,7 +983,7 @@ def generateMap(up=False):
             w,w,w,w,k,w,d,w,w]
         ]
     ]
-    map = []
+    map = bytearray([tl_rock])*(mapw*maph)
     grid = []
     gridw = 4
     gridh = 4
@@ -316,47 +991,45 @@ def generateMap(up=False):
     maxh = maph // gridh
     minw = maxw - 5
     minh = 4
-    for i in range(mapw*maph):
-        map.append(tl_rock)
     for i in range(gridw*gridh):
         grid.append(False)
-    rn = random.randrange(7, 10)
+    rn = rng.randrange(7, 10)
     rooms = []
     last = [0,0]
     for ri in range(rn):
-        i = random.randrange(0, gridw*gridh)
+        i = rng.randrange(0, gridw*gridh)
         while grid[i]:
             i = (i+1)%(gridw*gridh)
         grid[i] = True
         cx = (i%gridw) * maxw + maxw//2
         cy = (i//gridw) * maxh + maxh//2
-        if ri != 0 and random.randrange(0, 3) == 0:
-            pf = random.choice(prefabs)
+        if ri != 0 and rng.randrange(0, 3) == 0:
+            pf = rng.choice(prefabs)
             for i in range(pf[0]*pf[1]):
                 x = cx - pf[0]//2 + i % pf[0]
                 y = cy - pf[1]//2 + i // pf[0]
                 map[y*mapw+x] = pf[4][i]
             rooms.append([cx-pf[0]//2+pf[2], cy-pf[1]//2+pf[3]])
             continue
-        w = random.randrange(minw, maxw)
-        h = random.randrange(minh, maxh)
+        w = rng.randrange(minw, maxw)
+        h = rng.randrange(minh, maxh)
         if maxw-w > 1:
-            cx += random.randrange((maxw-w)//-2+1, (maxw-w)//2)
+            cx += rng.randrange((maxw-w)//-2+1, (maxw-w)//2)
         if maxh-h > 1:
-            cy += random.randrange((maxh-h)//-2+1, (maxh-h)//2)
+            cy += rng.randrange((maxh-h)//-2+1, (maxh-h)//2)
         for y in range(cy-h//2, cy+h//2):
             for x in range(cx-w//2, cx+w//2):
                 map[y*mapw+x] = tl_wall
         for y in range(cy-h//2+1, cy+h//2-1):
             for x in range(cx-w//2+1, cx+w//2-1):
                 map[y*mapw+x] = tl_room
-        x = random.randrange(cx-w//2+1, cx+w//2-1)
+        x = rng.randrange(cx-w//2+1, cx+w//2-1)
         map[(cy-h//2)*mapw+x] = tl_tdoor
-        x = random.randrange(cx-w//2+1, cx+w//2-1)
+        x = rng.randrange(cx-w//2+1, cx+w//2-1)
         map[(cy+h//2-1)*mapw+x] = tl_tdoor
-        y = random.randrange(cy-h//2+1, cy+h//2-1)
+        y = rng.randrange(cy-h//2+1, cy+h//2-1)
         map[y*mapw+cx-w//2] = tl_tdoor
-        y = random.randrange(cy-h//2+1, cy+h//2-1)
+        y = rng.randrange(cy-h//2+1, cy+h//2-1)
         map[y*mapw+cx+w//2-1] = tl_tdoor
         last = [cx, cy]
         rooms.append([cx, cy])
@@ -368,17 +1041,26 @@ def generateMap(up=False):
     # connect rooms
     first = rooms[0]
     connectRooms(rooms)
-    random.shuffle(rooms)
+    rng.shuffle(rooms)
     connectRooms(rooms)
-    for i in range(mapw*maph):
-        if map[i] == tl_temp:
-            map[i] = tl_rock
-        elif map[i] == tl_tdoor:
-            map[i] = tl_rock
-        elif map[i] == tl_wall:
-            map[i] = tl_rock
+    if useNumpy:
+        remap = numpy.arange(256, dtype=numpy.uint8)
+        remap[[tl_temp, tl_tdoor, tl_wall]] = tl_rock
+        m = gridView(map)
+        m[:] = remap[m]
+    else:
+        for i in range(mapw*maph):
+            if map[i] == tl_temp:
+                map[i] = tl_rock
+            elif map[i] == tl_tdoor:
+                map[i] = tl_rock
+            elif map[i] == tl_wall:
+                map[i] = tl_rock
     map[first[1]*mapw+first[0]] = tl_up
     map[last[1]*mapw+last[0]] = tl_down
+    mapChanged()
+    fieldCache.clear()
+    fovCache.clear()
 
     # init player
     if up:
@@ -390,20 +1072,11 @@ def generateMap(up=False):
 
     # place enemies
     def goblin(x, y):
-        gob = Actor(x=x, y=y, name="Goblin", hp=6)
-        gob.str = 3
-        gob.lvl = 3
-        return gob
+        return Actor(x=x, y=y, name="Goblin", hp=6, str=3, lvl=3)
     def slime(x, y):
-        slm = Actor(x=x, y=y, name="Slime", hp=4)
-        slm.str = 2
-        slm.lvl = 1
-        return slm
+        return Actor(x=x, y=y, name="Slime", hp=4, str=2, lvl=1)
     def orc(x, y):
-        orc = Actor(x=x, y=y, name="Orc", hp=12)
-        orc.str = 5
-        orc.lvl = 5
-        return orc
+        return Actor(x=x, y=y, name="Orc", hp=12, str=5, lvl=5)
     roomSpecs = [
         [4, [slime, slime, goblin]],
         [6, [slime, goblin, goblin]],
@@ -417,42 +1090,272 @@ def generateMap(up=False):
         [8, [orc]],
         [8, [orc]],
     ]
-    Actor.actors = [player]
-    spec = roomSpecs[level-1]
+    Actor.reset([player])
+    # levels past the last spec keep using it
+    spec = roomSpecs[min(level, len(roomSpecs))-1]
     for i in range(spec[0]):
-        r = rooms[random.choice(roomrg)]
+        r = rooms[rng.choice(roomrg)]
         occ = Actor.actorAt(r[0], r[1])
-        act = random.choice(spec[1])(r[0], r[1])
+        act = rng.choice(spec[1])(r[0], r[1])
         if occ != False:
             act.wander()
             act.wander()
+    if stressMonsters != 0:
+        free = [i for i in range(mapw*maph) \
+                if map[i] == tl_room and not i in Actor.cells]
+        for i in rng.sample(free, min(stressMonsters, len(free))):
+            rng.choice(spec[1])(i%mapw, i//mapw)
+        if len(free) < stressMonsters:
+            say("Only room for {} of the {} extra monsters, try a bigger " \
+                "map.".format(len(free), stressMonsters))
 
-    explored = []
-    for i in range(mapw*maph):
-        explored.append(not map[i] in Actor.passable)
+    explored = bytearray(mapw*maph)
+    if useNumpy:
+        gridView(explored)[:] = ~tileMask(tf_pass)[gridView(map)]
+    else:
+        for i in range(mapw*maph):
+            explored[i] = not tileFlags[map[i]] & tf_pass
+    indexExplored()
+    buildRegions()
     updateExplored(getFov(player.x, player.y))
     turn = 0
-    print("Level {}".format(level))
+    startSchedule()
+    say("Level {}".format(level))
+
+def packBits(buf):
+    # one bit per cell of a 0/1 grid such as explored, high bit first
+    if useNumpy:
+        return numpy.packbits(gridView(buf)).tobytes()
+    bits = bytearray((len(buf)+7)//8)
+    for i in range(len(buf)):
+        if buf[i]:
+            bits[i >> 3] |= 0x80 >> (i & 7)
+    return bytes(bits)
+
+def unpackBits(bits, n):
+    if useNumpy:
+        b = numpy.unpackbits(numpy.frombuffer(bits, dtype=numpy.uint8))
+        return bytearray(b[:n].tobytes())
+    buf = bytearray(n)
+    for i in range(n):
+        buf[i] = bits[i >> 3] >> (7-(i & 7)) & 1
+    return buf
+
+# fields of each actor in a level record, in order
+actorFields = ["x", "y", "hp", "mhp", "mp", "mmp", "str", "lvl", "xp",
+               "speed", "sleep", "dead"]
+# a level record is levelHead (the level's turn, the number of actors and
+# the length of their names), then the map as bytes, explored as bits,
+# actorFields as int32 for every actor but the player, and the actors'
+# names joined with newlines
+levelHead = struct.Struct("<iII")
+
+def intBytes(fields):
+    # little endian bytes of an array of ints, whatever the machine
+    if sys.byteorder == "big":
+        fields = array(fields.typecode, fields)
+        fields.byteswap()
+    return fields.tobytes()
+
+def bytesInts(code, buf):
+    fields = array(code)
+    fields.frombytes(buf)
+    if sys.byteorder == "big":
+        fields.byteswap()
+    return fields
+
+def packLevel():
+    # level record for the current level
+    fields = array("i")
+    names = []
+    for a in Actor.actors:
+        if a != player:
+            fields.extend([int(getattr(a, f)) for f in actorFields])
+            names.append(a.name)
+    text = "\n".join(names).encode()
+    return levelHead.pack(turn, len(names), len(text))+bytes(map)+ \
+           packBits(explored)+intBytes(fields)+text
+
+def unpackLevel(buf, stairs=-1):
+    # make a level record the current level, buf can be a slice of a
+    # mapped save file
+    # the player goes on the stairs they came by, or stays put if stairs
+    # is -1
+    global map
+    global explored
+    global turn
+    t, count, size = levelHead.unpack_from(buf, 0)
+    n = mapw*maph
+    o = levelHead.size
+    map = bytearray(buf[o:o+n])
+    o += n
+    explored = unpackBits(bytes(buf[o:o+(n+7)//8]), n)
+    o += (n+7)//8
+    nf = len(actorFields)
+    fields = bytesInts("i", buf[o:o+count*nf*4])
+    o += count*nf*4
+    names = bytes(buf[o:o+size]).decode().split("\n")
+    mapChanged()
+    if stairs != -1:
+        i = map.index(stairs)
+        player.x = i%mapw
+        player.y = i//mapw
+    Actor.reset([player])
+    for j in range(count):
+        f = fields[j*nf:j*nf+nf]
+        a = Actor(x=f[0], y=f[1], name=names[j])
+        for k in range(2, nf-1):
+            setattr(a, actorFields[k], f[k])
+        if f[nf-1]:
+            a.die()
+    indexExplored()
+    buildRegions()
+    updateExplored(getFov(player.x, player.y))
+    turn = t
+    startSchedule()
+    say("Level {}".format(level))
+
+def spillLevel(depth, record):
+    # a level pushed out of levels goes to a file until it is needed
+    global levelDir
+    if levelDir == None:
+        levelDir = tempfile.mkdtemp(prefix="textrogue-")
+        atexit.register(shutil.rmtree, levelDir, True)
+    path = os.path.join(levelDir, "level{}".format(depth))
+    with open(path, "wb") as f:
+        f.write(record)
+    levelFiles[depth] = path
+
+def changeLevel(depth, up=False):
+    # leave the current level for depth, which is restored from its
+    # record if the player has been there, or generated if not
+    global level
+    levels.put(level, packLevel())
+    level = depth
+    record = levels.pop(depth)
+    if record == None and depth in levelFiles:
+        path = levelFiles.pop(depth)
+        with open(path, "rb") as f:
+            record = f.read()
+        os.remove(path)
+    if record == None and depth in savedLevels:
+        o, n = savedLevels.pop(depth)
+        record = saveMap[o:o+n]
+    if record == None:
+        generateMap(up)
+    else:
+        unpackLevel(record, tl_down if up else tl_up)
+    if autosave != None:
+        saveGame(autosave)
+
+# a save file is saveHead (magic, version, map size, level, total turns,
+# number of levels and words of random number state), the player's
+# playerFields as int32, the random number state as uint32, a dirEntry
+# (depth, offset and length) for each level, and then the level records,
+# the current level's first
+saveMagic = b"TRSV"
+saveVersion = 1
+saveHead = struct.Struct("<4sHHHIqII")
+dirEntry = struct.Struct("<IQQ")
+playerFields = actorFields+["mxp"]
+
+def saveGame(path):
+    # every level the game kept is written, levels still in a loaded
+    # save file are copied across as they are
+    records = [(level, packLevel())]
+    for depth, record in levels.items.items():
+        records.append((depth, record))
+    for depth, p in levelFiles.items():
+        with open(p, "rb") as f:
+            records.append((depth, f.read()))
+    for depth, (o, n) in savedLevels.items():
+        records.append((depth, saveMap[o:o+n]))
+    words = array("I", rng.getstate()[1])
+    fields = array("i", [int(getattr(player, f)) for f in playerFields])
+    o = saveHead.size+len(fields)*4+len(words)*4+dirEntry.size*len(records)
+    # written next to the old file and moved over it, so a mapped copy of
+    # the old one stays intact
+    tmp = path+".tmp"
+    with open(tmp, "wb") as f:
+        f.write(saveHead.pack(saveMagic, saveVersion, mapw, maph, level, \
+                              totalTurns, len(records), len(words)))
+        f.write(intBytes(fields))
+        f.write(intBytes(words))
+        for depth, record in records:
+            f.write(dirEntry.pack(depth, o, len(record)))
+            o += len(record)
+        for depth, record in records:
+            f.write(record)
+    os.replace(tmp, path)
+
+def loadGame(path):
+    # the file is mapped rather than read, only the current level is
+    # unpacked, the rest wait in savedLevels until the player gets there
+    global saveMap
+    global savedLevels
+    global level
+    global totalTurns
+    global rng
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mm) < saveHead.size or mm[:4] != saveMagic:
+        raise ValueError("{} is not a textrogue save".format(path))
+    magic, version, w, h, lvl, total, count, nwords = \
+        saveHead.unpack_from(mm, 0)
+    if version != saveVersion:
+        raise ValueError("{} is save version {}, not {}".format \
+                         (path, version, saveVersion))
+    if w != mapw or h != maph:
+        raise ValueError("{} has a {}x{} map, not {}x{}".format \
+                         (path, w, h, mapw, maph))
+    o = saveHead.size
+    fields = bytesInts("i", mm[o:o+len(playerFields)*4])
+    o += len(playerFields)*4
+    words = bytesInts("I", mm[o:o+nwords*4])
+    o += nwords*4
+    for k in range(len(playerFields)):
+        setattr(player, playerFields[k], fields[k])
+    player.dead = player.dead != 0
+    rng = random.Random()
+    rng.setstate((3, tuple(words), None))
+    saveMap = mm
+    savedLevels = {}
+    current = None
+    for i in range(count):
+        depth, off, n = dirEntry.unpack_from(mm, o+i*dirEntry.size)
+        if current == None:
+            current = (off, n)
+        else:
+            savedLevels[depth] = (off, n)
+    level = lvl
+    totalTurns = total
+    unpackLevel(mm[current[0]:current[0]+current[1]])
 
 def printMap():
     for i in range(mapw*maph):
-        print(tileChars[map[i]], end="")
+        say(tileChars[map[i]], end="")
         if (i+1)%mapw == 0:
-            print("")
+            say("")
 
 def roomSize(x, y):
+    # rooms that fill their bounding box are looked up in the region map,
+    # anything else is measured by walking out from x,y
+    if regionVersion != mapVersion:
+        buildRegions()
+    r = regionMap[y*mapw+x] if inBounds(x, y) else -1
+    if r != -1 and regionKinds[r] == 0 and regionRect[r]:
+        return list(regionBox[r])
     rx = x
     ry = y
-    nroom = [tl_door, tl_rock, tl_path]
-    while not getTile(rx, y) in nroom:
+    while tileFlags[getTile(rx, y)] & tf_room:
         rx -= 1
-    while not getTile(x, ry) in nroom:
+    while tileFlags[getTile(x, ry)] & tf_room:
         ry -= 1
     rx2 = x
     ry2 = y
-    while not getTile(rx2, y) in nroom:
+    while tileFlags[getTile(rx2, y)] & tf_room:
         rx2 += 1
-    while not getTile(x, ry2) in nroom:
+    while tileFlags[getTile(x, ry2)] & tf_room:
         ry2 += 1
     rx += 1
     ry += 1
@@ -474,6 +1377,9 @@ def whereStr(x1, y1, x2, y2):
         str += " {} S".format(y2-y1)
     return str
 
+def say(text="", end="\n"):
+    output.append(text+end)
+
 listVars = []
 
 def listStart(start1, start2):
@@ -486,16 +1392,19 @@ def listItem(str):
     if listVars[2]:
         listVars[2] = False
         start = listVars[0]
-    print("{} {}".format(start, str))
+    say("{} {}".format(start, str))
 
 def describe(x, y, status=True):
-    print()
+    if quiet:
+        return
+    say()
     if status:
-        print("HP {}/{} MP {}/{}".format(player.hp, player.mhp, \
+        say("HP {}/{} MP {}/{}".format(player.hp, player.mhp, \
               player.mp, player.mmp))
     fov = getFov(x, y)
+    seen = set(fov)
     if map[y*mapw+x] == tl_door:
-        print("You are in a doorway")
+        say("You are in a doorway")
         listStart("There is", "And")
         for i in range(len(dirs)):
             d = dirs[i]
@@ -514,7 +1423,7 @@ def describe(x, y, status=True):
             d = dirs[i]
             if getTile(x+d[0], y+d[1]) == tl_path:
                 ptype += " " + dirLetters[i]
-        print("You are in a{} corridor".format(ptype))
+        say("You are in a{} corridor".format(ptype))
         listStart("With", "And")
         for di in range(len(dirs)):
             d = dirs[di]
@@ -525,19 +1434,15 @@ def describe(x, y, status=True):
             while getTile(xx+d[0], yy+d[1]) == tl_path:
                 xx += d[0]
                 yy += d[1]
-                if not sees(x, y, xx, yy):
+                if not yy*mapw+xx in seen:
                     break
-                fork = []
-                for i in range(len(dirs)):
-                    dd = dirs[i]
-                    if getTile(xx+dd[0], yy+dd[1]) == tl_path:
-                        fork.append(i)
+                fork = corridorNodes.get(yy*mapw+xx)
+                if fork == None:
+                    continue
                 if len(fork) == 1:
-                    dd = dirs[fork[0]]
-                    if getTile(xx+dd[0], yy+dd[1]) == tl_rock:
-                        listItem("a dead end {}".format \
-                              (whereStr(x, y, xx+dd[0], yy+dd[1])))
-                elif len(fork) == 2 and not di in fork:
+                    listItem("a dead end {}".format \
+                             (whereStr(x, y, xx, yy)))
+                elif len(fork) == 2:
                     ttype = ""
                     for fd in fork:
                         if fd != (di+2)%4:
@@ -553,22 +1458,19 @@ def describe(x, y, status=True):
                              (ftype, whereStr(x, y, xx, yy)))
     else:
         sz = roomSize(x, y)
-        print("You are in a {}x{} room at {} {}".format \
+        say("You are in a {}x{} room at {} {}".format \
               (sz[2], sz[3], x-sz[0], y-sz[1]))
     mapObjects = []
     listStart("There is", "And")
-    for i in range(mapw*maph):
-        if fov[i]:
-            if map[i] in [tl_door, tl_up, tl_down]:
-                xd = i%mapw-x
-                yd = i//mapw-y
-                listItem("{} {}".format \
-                      (tileNames[map[i]], \
-                       whereStr(x, y, i%mapw, i//mapw)))
+    for i in fov:
+        if tileFlags[map[i]] & tf_mark:
+            listItem("{} {}".format \
+                  (tileNames[map[i]], \
+                   whereStr(x, y, i%mapw, i//mapw)))
     listStart("There is", "And")
-    for a in Actor.actors:
+    for a in Actor.near(x, y, sightDist):
         if a != player:
-            if sees(x, y, a.x, a.y):
+            if a.y*mapw+a.x in seen:
                 if a.dead:
                     listItem("a dead {} {}".format \
                              (a.name, whereStr(x, y, a.x, a.y)))
@@ -577,18 +1479,90 @@ def describe(x, y, status=True):
                              (a.name, whereStr(x, y, a.x, a.y)))
 
 def gameOver():
-    print("GAME OVER")
+    global ending
+    say("GAME OVER")
+    ending = "dead"
 
 def leaveDungeon():
-    print("You leave the dungeon.")
+    global ending
+    say("You leave the dungeon.")
+    ending = "left"
+
+# heap of [tick, actor id, event, actor, gen], with turnTicks ticks to a
+# turn, events whose gen is behind the actor's are dropped
+# events for one actor on the same tick run in the order ev_mp, ev_hp,
+# ev_act, and actors on the same tick go in order of creation
+schedule = []
+turnTicks = 100
+ev_mp = 0
+ev_hp = 1
+ev_act = 2
+# turns between regen ticks
+mpRegen = 12
+hpRegen = 8
+
+def nextTurn(every):
+    # first turn from now that is a multiple of every
+    return (turn+every-1)//every*every
+
+def startSchedule():
+    global schedule
+    schedule = []
+    for a in Actor.actors:
+        if not a.dead:
+            scheduleActor(a)
+
+def scheduleActor(a):
+    # replaces whatever the actor had scheduled, so waking up doesn't leave
+    # a second set of events behind
+    a.gen += 1
+    g = a.gen
+    heappush(schedule, [nextTurn(mpRegen)*turnTicks, a.id, ev_mp, a, g])
+    heappush(schedule, [nextTurn(hpRegen)*turnTicks, a.id, ev_hp, a, g])
+    if a != player:
+        heappush(schedule, [turn*turnTicks, a.id, ev_act, a, g])
+
+def dormant(a):
+    return dormantDist != 0 and a != player and \
+           max(abs(a.x-player.x), abs(a.y-player.y)) > dormantDist
 
 def update():
+    if dormantDist != 0:
+        for a in Actor.near(player.x, player.y, dormantDist):
+            if a.sleep != -1 and not a.dead:
+                a.wake()
+    runTurn()
+
+def runTurn():
+    # run everything scheduled for this turn, dead and dormant actors and
+    # stale events drop out of the schedule as they come up
     global turn
-    for a in Actor.actors:
-        a.update()
-        if a != player:
+    global totalTurns
+    global chaseMap
+    chaseMap = None
+    end = (turn+1)*turnTicks
+    while len(schedule) != 0 and schedule[0][0] < end:
+        e = heappop(schedule)
+        a = e[3]
+        if a.dead or a.sleep != -1 or e[4] != a.gen:
+            continue
+        if e[2] == ev_mp:
+            if a.mp < a.mmp:
+                a.mp += 1
+            e[0] += mpRegen*turnTicks
+        elif e[2] == ev_hp:
+            if a.hp < a.mhp:
+                a.hp += 1
+            e[0] += hpRegen*turnTicks
+        elif dormant(a):
+            a.sleep = turn
+            continue
+        else:
             a.enemyUpdate()
+            e[0] += turnTicks*100//a.speed
+        heappush(schedule, e)
     turn += 1
+    totalTurns += 1
 
 def levelUp():
     player.lvl += 1
@@ -602,24 +1576,57 @@ def levelUp():
     player.hp = math.floor(player.hp*(player.mhp/oldhp))
     player.mmp += math.floor(0.25*player.lvl)
     player.mp = math.floor(player.mp*(player.mmp/oldmp))
-    print()
-    print("Level up!")
+    say()
+    say("Level up!")
     if oldstr != player.str:
-        print("STR\t{}\tto {}".format(oldstr, player.str))
+        say("STR\t{}\tto {}".format(oldstr, player.str))
     if oldhp != player.mhp:
-        print("Max HP\t{}\tto {}".format(oldhp, player.mhp))
+        say("Max HP\t{}\tto {}".format(oldhp, player.mhp))
     if oldmp != player.mmp:
-        print("Max MP\t{}\tto {}".format(oldmp, player.mmp))
+        say("Max MP\t{}\tto {}".format(oldmp, player.mmp))
     if player.xp >= player.mxp:
         levelUp()
 
+def quietTurns():
+    # turns no monster can get within sight, putting every monster to sleep
+    # so they can be skipped with runTurn(), 0 if one could
+    if dormantDist == 0:
+        return 0
+    near = []
+    quiet = 1000
+    for a in Actor.near(player.x, player.y, dormantDist):
+        if a != player and not a.dead:
+            if a.sleep != -1:
+                # asleep since the last quiet stretch, wake it as update()
+                # would so it is measured from where it has got to
+                a.wake()
+            d = max(abs(a.x-player.x), abs(a.y-player.y))
+            steps = (a.speed+99)//100
+            quiet = min(quiet, (d-sightDist-1)//steps)
+            near.append(a)
+    if quiet <= 1:
+        return 0
+    for a in near:
+        # this turn's events are dropped along with the rest, and wake()
+        # only counts regen after the turn it went to sleep, so this turn's
+        # regen is given now
+        if turn%mpRegen == 0 and a.mp < a.mmp:
+            a.mp += 1
+        if turn%hpRegen == 0 and a.hp < a.mhp:
+            a.hp += 1
+        a.sleep = turn
+    return quiet
+
 def safe():
-    for a in Actor.actors:
+    for a in Actor.near(player.x, player.y, sightDist):
         if a != player and not a.dead:
-            if sees(player.x, player.y, a.x, a.y):
+            if inView(a.x, a.y):
                 return False
     return True
 
+def stopping():
+    return stopTurn >= 0 and totalTurns >= stopTurn
+
 def autoMove(x, y):
     old = map[player.y*mapw+player.x]
     player.moveAlert(x, y)
@@ -629,98 +1636,134 @@ def autoMove(x, y):
         describe(player.x, player.y, status=False)
 
 def findTile(t):
-    pmap = pathMap(Actor.passable, player.x, player.y)
+    # closest explored tile of type t (a door or stairs), ties going to the
+    # lowest index
+    field = regionField(player.y*mapw+player.x)
     closest = -1
-    for i in range(mapw*maph):
-        if map[i] == t and explored[i] and pmap[i] > 1:
-            if closest == -1:
-                closest = i
-            elif pmap[i] < pmap[closest]:
+    best = -1
+    for i in knownTiles[t]:
+        d = fieldDist(field, i)
+        if d > 0:
+            if closest == -1 or d < best or (d == best and i < closest):
                 closest = i
+                best = d
     return closest
 
 def tileKnown(t):
-    for i in range(mapw*maph):
-        if explored[i] and map[i] == t:
-            return True
-    return False
+    return len(knownTiles[t]) != 0
+
+def closestUnexplored(x, y):
+    # breadth-first search from x,y that stops at the first distance with
+    # frontier cells on it - the closest unexplored cells are their
+    # unexplored neighbours, ties go to the lowest index
+    seen = set([y*mapw+x])
+    ring = [y*mapw+x]
+    while ring:
+        closest = -1
+        for i in ring:
+            if i in frontier:
+                for n in neighbours(i):
+                    if not explored[n] and (closest == -1 or n < closest):
+                        closest = n
+        if closest != -1:
+            return closest
+        next = []
+        for i in ring:
+            for n in neighbours(i):
+                if not n in seen and tileFlags[map[n]] & tf_pass:
+                    seen.add(n)
+                    next.append(n)
+        ring = next
+    return -1
 
 def explore():
-    all = True
-    for x in explored:
-        if not x:
-            all = False
-            break
-    if all:
-        print("Map explored.")
+    # explorePlan is [target, cell the player should be on, map version,
+    # rest of the path]
+    # revealing cells can't bring another unexplored cell closer than the
+    # target, and the rest of a path is the path from its next cell, so the
+    # route only has to be planned again once the target is explored, the
+    # map changes or the player didn't end up where expected
+    global explorePlan
+    if unexploredCount == 0:
+        say("Map explored.")
         return False
     if not safe():
-        print("Monsters nearby.")
+        explorePlan = None
+        say("Monsters nearby.")
         describe(player.x, player.y)
         return False
     foundExit = tileKnown(tl_down)
-    pmap = pathMap(Actor.passable, player.x, player.y)
-    closest = player.y*mapw+player.x
-    for i in range(mapw*maph):
-        if explored[i] == False:
-            if explored[closest] or pmap[i] < pmap[closest]:
-                closest = i
-    p = findPath(Actor.passable, player.x, player.y, \
-                 closest%mapw, closest//mapw)
-    if len(p) == 0:
-        print("Explored all accessible areas.")
+    if areaUnexplored[areaMap[player.y*mapw+player.x]] != unexploredCount:
+        say("Explored all accessible areas.")
         return False
-    autoMove(p[0][0], p[0][1])
+    plan = explorePlan
+    if plan == None or explored[plan[0]] or plan[2] != mapVersion \
+            or plan[1] != player.y*mapw+player.x or len(plan[3]) == 0:
+        closest = closestUnexplored(player.x, player.y)
+        p = findPath(Actor.passable, player.x, player.y, \
+                     closest%mapw, closest//mapw, astar=True)
+        if len(p) == 0:
+            explorePlan = None
+            say("Explored all accessible areas.")
+            return False
+        plan = [closest, 0, mapVersion, p]
+    step = plan[3][0]
+    explorePlan = [plan[0], step[1]*mapw+step[0], plan[2], plan[3][1:]]
+    autoMove(step[0], step[1])
     if not foundExit:
         if tileKnown(tl_down):
-            print("Found exit.")
+            say("Found exit.")
             describe(player.x, player.y)
             return False
     return True
 
 def rest():
-    hp = player.hp != player.mhp
-    mp = player.mp != player.mmp
+    hp = player.hp < player.mhp
+    mp = player.mp < player.mmp
     if not mp and not hp:
-        print("No need.")
+        say("No need.")
         return
-    while True:
+    skip = 0
+    while not stopping():
         if safe():
-            update()
-            if player.hp == player.mhp and hp:
-                print("HP restored")
-            if player.mp == player.mmp and mp:
-                print("MP restored")
+            if skip == 0:
+                skip = quietTurns()
+            if skip != 0:
+                skip -= 1
+                runTurn()
+            else:
+                update()
+            if player.hp >= player.mhp and hp:
+                say("HP restored")
+            if player.mp >= player.mmp and mp:
+                say("MP restored")
                 break
-            if player.hp == player.mhp and hp:
+            if player.hp >= player.mhp and hp:
                 break
         else:
-            print("Monsters nearby.")
+            say("Monsters nearby.")
             break
     describe(player.x, player.y)
 
 def target(x2, y2, str):
-    path = findPath(Actor.passable, player.x, player.y, x2, y2)
+    path = regionPath(player.x, player.y, x2, y2)
     if len(path) == 0:
-        print("No path.")
+        say("No path.")
         return
     for p in path:
+        if stopping():
+            return
         if not safe():
-            print("Monsters nearby.")
+            say("Monsters nearby.")
             describe(player.x, player.y)
             return
         autoMove(p[0], p[1])
-    print("Arrived at {}.".format(str))
+    say("Arrived at {}.".format(str))
     describe(player.x, player.y)
 
-def yes(prompt):
-    yn = input("{} y/N ".format(prompt)).strip().lower()
-    return yn in ["y", "ye", "yes", "yeah"]
 
-player = Actor(name="Player", hp=10, mp=2)
-player.lvl = 1
-player.mxp = 3
-player.str = 3
+def yes(answer):
+    return answer.strip().lower() in ["y", "ye", "yes", "yeah"]
 
 helpList = [
     ["help", "Show this list"],
@@ -733,6 +1776,9 @@ helpList = [
     ["", "\"entrance\", \"exit\" or \"door\""],
     ["rest", "Rest until HP/MP are restored"],
     ["explore", "Explore the map"],
+    ["save [file]", "Save the game, to textrogue.sav by default"],
+    ["stats [on/off/reset]", "Show where the time went, see"],
+    ["", "TEXTROGUE_PROFILE"],
 ]
 
 helpExtra = [
@@ -740,28 +1786,29 @@ helpExtra = [
     "instead of \"go entrance\").",
 ]
 
-print("textrogue - tdwsl 2022")
-print("Type \"help\" for a list of game commands")
-
-generateMap()
-#printMap()
+def endTurn():
+    update()
+    if player.hp <= 0:
+        gameOver()
+        return
+    if player.xp >= player.mxp:
+        levelUp()
+    describe(player.x, player.y)
+    updateExplored(getFov(player.x, player.y))
 
-upd = False
-describe(player.x, player.y)
-while True:
-    if upd:
-        update()
-        if player.hp <= 0:
-            gameOver()
-            break
-        if player.xp >= player.mxp:
-            levelUp()
-        describe(player.x, player.y)
-        updateExplored(getFov(player.x, player.y))
+def command(text):
+    # run one line of input against the current game
+    global asking
+    global ending
+    if asking != None:
+        asking = None
+        if yes(text):
+            leaveDungeon()
+        return
     upd = False
-    line = input(">").strip().lower().split(" ")
+    line = text.strip().lower().split(" ")
     if line[0] == "":
-        print("Enter a command.")
+        say("Enter a command.")
     elif "north".startswith(line[0]):
         upd = player.moveAlert(player.x, player.y-1)
     elif "east".startswith(line[0]):
@@ -773,49 +1820,63 @@ while True:
     elif "up".startswith(line[0]):
         if map[player.y*mapw+player.x] == tl_up:
             if level == 1:
-                if yes("Leave the dungeon?"):
-                    leaveDungeon()
-                    break
+                asking = "Leave the dungeon?"
             else:
-                print("You ascend up a maze of stairs...")
-                level -= 1
-                generateMap(up=True)
+                say("You ascend up a maze of stairs...")
+                changeLevel(level-1, up=True)
                 describe(player.x, player.y)
         else:
-            print("There is no way up here.")
+            say("There is no way up here.")
     elif "down".startswith(line[0]):
         if map[player.y*mapw+player.x] == tl_down:
-            print("You descend down a maze of stairs...")
-            level += 1
-            generateMap()
+            say("You descend down a maze of stairs...")
+            changeLevel(level+1)
             describe(player.x, player.y)
         else:
-            print("There is no way down here.")
+            say("There is no way down here.")
     elif "wait".startswith(line[0]):
-        print("You wait.")
+        say("You wait.")
         upd = True
     elif "quit".startswith(line[0]):
-        #if yes("Really quit?"):
-            #break
-        break
+        ending = "quit"
     elif "help".startswith(line[0]):
-        print()
+        say()
         for h in helpList:
-            print("{}{}{}".format(h[0], "\t"*(3 - len(h[0])//8), h[1]))
-        print()
+            say("{}{}{}".format(h[0], "\t"*(3 - len(h[0])//8), h[1]))
+        say()
         for h in helpExtra:
-            print(h)
+            say(h)
     elif "look".startswith(line[0]):
         describe(player.x, player.y)
     elif "explore".startswith(line[0]):
-        while explore():
+        while not stopping() and explore():
             continue
     elif "rest".startswith(line[0]):
         rest()
+    elif "save".startswith(line[0]) and len(line[0]) > 1:
+        path = text.strip().split(" ", 1)[1] if len(line) > 1 \
+               else "textrogue.sav"
+        try:
+            saveGame(path)
+            say("Saved to {}.".format(path))
+        except OSError as e:
+            say("Couldn't save: {}".format(e.strerror))
+    elif "stats".startswith(line[0]) and len(line[0]) > 1:
+        if len(line) > 1 and line[1] in ["on", "off"]:
+            setProfiling(line[1] == "on")
+            say("Profiling {}.".format(line[1]))
+        elif len(line) > 1 and line[1] == "reset":
+            resetStats()
+            say("Profiling counters reset.")
+        elif not profiling:
+            say("Profiling is off, turn it on with \"stats on\".")
+        else:
+            for l in statsReport():
+                say(l)
     elif "go".startswith(line[0]):
         if not safe():
-            print("Monsters nearby.")
-            continue
+            say("Monsters nearby.")
+            return
         if len(line) > 1:
             if line[1] == "to":
                 del line[1]
@@ -834,13 +1895,574 @@ while True:
         elif line[1] == "door":
             xy = findTile(tl_door)
         else:
-            print("Invalid location.")
-            continue
+            say("Invalid location.")
+            return
         if xy == -1:
-            print("Couldn't find location - try exploring first.")
-            continue
-        print("Targeting {} {}".format \
-              (line[1], whereStr(player.x, player.y, xy%mapw, xy//mapw)))
+            say("Couldn't find location - try exploring first.")
+            return
+        say("Targeting {} {}".format \
+            (line[1], whereStr(player.x, player.y, xy%mapw, xy//mapw)))
         target(xy%mapw, xy//mapw, line[1])
     else:
-        print("You can't do that.")
+        say("You can't do that.")
+    if upd:
+        endTurn()
+
+# module level state that belongs to a game, and the Actor class state
+gameVars = ["map", "explored", "unexploredCount", "knownTiles", "frontier",
+            "areaMap", "areaUnexplored", "explorePlan", "player", "level",
+            "turn", "chaseMap", "mapVersion", "rng", "output", "asking",
+            "ending", "totalTurns", "quiet", "regionMap", "regionPortals",
+            "regionBox", "regionRect", "portalDist", "portalLinks",
+            "regionKinds", "corridorNodes", "regionVersion", "fieldCache",
+            "fovCache", "listVars", "schedule", "levels", "levelDir",
+            "levelFiles", "saveMap", "savedLevels", "autosave"]
+actorVars = ["actors", "nextId", "cells", "buckets"]
+
+class Game:
+    # one game's worth of state, driven with step() instead of input()
+    # the functions above work on module level state, which belongs to
+    # whichever game was entered last, so any number of games can be
+    # played in turn in one process
+    current = None
+
+    # path loads a saved game instead of starting a new one, and save is a
+    # file to save to whenever the player takes the stairs
+    # log is a file every command is written to, see replay
+    # without a seed one is picked, game.seed has it either way
+    def __init__(self, seed=None, brief=False, path=None, save=None,
+                 log=None):
+        global map, explored, unexploredCount, knownTiles, frontier
+        global areaMap, areaUnexplored, explorePlan, player, level, turn
+        global chaseMap, mapVersion, rng, output, asking, ending
+        global totalTurns, quiet, levels, levelDir, levelFiles
+        global saveMap, savedLevels, autosave
+        global regionVersion, fieldCache, fovCache, listVars, schedule
+        if Game.current != None:
+            Game.current.stash()
+        Game.current = self
+        map = bytearray()
+        explored = bytearray()
+        unexploredCount = 0
+        knownTiles = {}
+        frontier = set()
+        areaMap = []
+        areaUnexplored = []
+        explorePlan = None
+        level = 1
+        turn = 0
+        chaseMap = None
+        mapVersion = 0
+        if seed == None:
+            seed = random.randrange(2**32)
+        self.seed = seed
+        rng = random.Random(seed)
+        output = []
+        asking = None
+        ending = None
+        totalTurns = 0
+        quiet = brief
+        regionVersion = -1
+        fieldCache = Cache(fieldCacheSize)
+        fovCache = Cache(256)
+        listVars = []
+        schedule = []
+        levels = Cache(levelCacheSize, spillLevel)
+        levelDir = None
+        levelFiles = {}
+        saveMap = None
+        savedLevels = {}
+        autosave = save
+        Actor.reset([])
+        Actor.nextId = 0
+        player = Actor(name="Player", hp=10, mp=2, str=3, lvl=1)
+        player.mxp = 3
+        say("textrogue - tdwsl 2022")
+        say("Type \"help\" for a list of game commands")
+        if path == None:
+            generateMap()
+        else:
+            loadGame(path)
+        describe(player.x, player.y)
+        # what the game says before the first command
+        self.intro = self.events()
+        self.log = None
+        if log != None:
+            # line buffered so a crash keeps every command up to it
+            self.log = open(log, "w", buffering=1)
+            self.log.write(json.dumps({"replay": logVersion, "seed": seed,
+                                       "load": path, "mapw": mapw,
+                                       "maph": maph,
+                                       "stress": stressMonsters})+"\n")
+
+    def stash(self):
+        g = globals()
+        self.vars = {k: g[k] for k in gameVars}
+        self.actorVars = {k: getattr(Actor, k) for k in actorVars}
+
+    def enter(self):
+        if Game.current == self:
+            return
+        if Game.current != None:
+            Game.current.stash()
+        Game.current = self
+        globals().update(self.vars)
+        for k in actorVars:
+            setattr(Actor, k, self.actorVars[k])
+
+    def events(self):
+        # lines said since the last call
+        global output
+        lines = "".join(output).splitlines()
+        output = []
+        return lines
+
+    def step(self, text):
+        # run a line of input, returns the lines of output it produced
+        self.enter()
+        if ending == None:
+            if self.log != None:
+                self.log.write(text.rstrip("\n")+"\n")
+            if profiling:
+                t = time.perf_counter()
+                command(text)
+                countCommand(text, time.perf_counter()-t)
+            else:
+                command(text)
+        return self.events()
+
+    def prompt(self):
+        self.enter()
+        if asking != None:
+            return "{} y/N ".format(asking)
+        return ">"
+
+    def over(self):
+        self.enter()
+        return ending != None
+
+    def result(self):
+        # summary of where the game stands
+        self.enter()
+        return {"result": ending, "level": level, "turns": totalTurns,
+                "lvl": player.lvl, "hp": player.hp, "xp": player.xp}
+
+    def close(self):
+        # remove the levels spilled to files and let go of the save and the
+        # log, the game can't go on after this
+        # atexit only backs this up, it doesn't run in --sim's workers
+        global levelDir, levelFiles, saveMap, savedLevels
+        self.enter()
+        if levelDir != None:
+            shutil.rmtree(levelDir, True)
+        levelDir = None
+        levelFiles = {}
+        if saveMap != None:
+            saveMap.close()
+        saveMap = None
+        savedLevels = {}
+        if self.log != None:
+            self.log.close()
+        self.log = None
+
+def play(game):
+    # text front end
+    while not game.over():
+        for l in game.step(input(game.prompt())):
+            print(l)
+    game.close()
+
+def batch(lines, seed=None, brief=False, log=None):
+    # run a stream of commands until it runs out or the game ends, and
+    # return the game's result with the number of commands used
+    game = Game(seed, brief, log=log)
+    n = 0
+    for line in lines:
+        if game.over():
+            break
+        game.step(line)
+        n += 1
+    r = game.result()
+    game.close()
+    if r["result"] == None:
+        r["result"] = "eof"
+    r["commands"] = n
+    return r
+
+def mapSize(text):
+    # WxH for --size, no smaller than the default map the rooms are laid
+    # out for
+    try:
+        w, h = [int(n) for n in text.lower().split("x")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} is not WxH".format(text))
+    if w < 50 or h < 30:
+        raise argparse.ArgumentTypeError("the map is at least 50x30")
+    return (w, h)
+
+# replay logs: a json line with the seed, the save the game started from,
+# the map size and the stress setting, then every command as it was typed
+# cuts in the header are [command, turn] for commands that a replay
+# stopped part way through before play carried on
+logVersion = 1
+# commands that don't change the game, left out of replays so they don't
+# write files or turn profiling on
+replaySkips = ["save", "stats"]
+
+def logName(seed):
+    # default replay log for a game, numbered past any log that is already
+    # there so starting a game never writes over an old one
+    path = "textrogue-{}.log".format(seed)
+    n = 1
+    while os.path.exists(path):
+        n += 1
+        path = "textrogue-{}-{}.log".format(seed, n)
+    return path
+
+def replay(path, until=-1):
+    # rerun a replay log without describing anything, stopping at turn
+    # until if it is given, part way through a command if need be
+    # returns the game, the log's header and the number of commands run
+    global stressMonsters, stopTurn, mapw, maph
+    with open(path) as f:
+        head = json.loads(f.readline())
+        if head.get("replay") != logVersion:
+            raise ValueError("{} is not a replay log".format(path))
+        cuts = {c[0]: c[1] for c in head.get("cuts", [])}
+        stressMonsters = head["stress"]
+        mapw = head.get("mapw", mapw)
+        maph = head.get("maph", maph)
+        game = Game(head["seed"], brief=True, path=head["load"])
+        n = 0
+        for line in f:
+            if game.over() or (until >= 0 and totalTurns >= until):
+                break
+            if asking != None or not commandName(line) in replaySkips:
+                stopTurn = cuts.get(n, -1)
+                if until >= 0 and (stopTurn < 0 or until < stopTurn):
+                    stopTurn = until
+                game.step(line)
+                stopTurn = -1
+            n += 1
+    game.events()
+    return game, head, n
+
+def explorerBot(restAt=0.6):
+    # command for the current game: fight whatever is in sight, rest when
+    # hurt, otherwise head for the exit, exploring until it is found
+    if map[player.y*mapw+player.x] == tl_down:
+        return "down"
+    foe = None
+    for a in Actor.near(player.x, player.y, sightDist):
+        if a != player and not a.dead and inView(a.x, a.y):
+            if foe == None or abs(a.x-player.x)+abs(a.y-player.y) < \
+                    abs(foe.x-player.x)+abs(foe.y-player.y):
+                foe = a
+    if foe != None:
+        p = findPath(Actor.passable, player.x, player.y, foe.x, foe.y, \
+                     astar=True, blocked=Actor.cells)
+        if len(p) == 0:
+            return "wait"
+        d = [p[0][0]-player.x, p[0][1]-player.y]
+        return dirNames[dirs.index(d)]
+    if player.hp < player.mhp*restAt:
+        return "rest"
+    if tileKnown(tl_down):
+        return "go exit"
+    return "explore"
+
+def diverBot():
+    # explorerBot that never rests
+    return explorerBot(restAt=0)
+
+bots = {"explorer": explorerBot, "diver": diverBot}
+
+def runBot(seed, bot="explorer", limit=1000, stress=0, checkSave=0,
+           size=None):
+    # play a seeded game with one of the bots, giving up after limit
+    # commands
+    # with checkSave the game is saved after that many commands and a copy
+    # loaded from the save is given the same commands, saveCheck in the
+    # result says whether the copy kept playing the same game
+    # size is the map's (width, height), the current one by default
+    global stressMonsters, mapw, maph
+    stressMonsters = stress
+    if size != None:
+        mapw, maph = size
+    game = Game(seed, brief=True)
+    policy = bots[bot]
+    copy = None
+    same = True
+    n = 0
+    d = None
+    try:
+        while not game.over() and n < limit:
+            if n == checkSave and checkSave > 0:
+                d = tempfile.mkdtemp(prefix="textrogue-")
+                saveGame(os.path.join(d, "check.sav"))
+                copy = Game(path=os.path.join(d, "check.sav"), brief=True)
+                copy.events()
+            game.enter()
+            c = policy()
+            lines = game.step(c)
+            if copy != None and same:
+                same = copy.step(c) == lines and \
+                       copy.result() == game.result()
+            n += 1
+        r = game.result()
+    finally:
+        # atexit doesn't run in --sim's workers, so clean up here
+        if copy != None:
+            copy.close()
+        game.close()
+        if d != None:
+            shutil.rmtree(d, True)
+    if r["result"] == None:
+        r["result"] = "limit"
+    r["seed"] = seed
+    r["commands"] = n
+    if copy != None:
+        r["saveCheck"] = same
+    return r
+
+def simulate(seeds, bot="explorer", jobs=None, limit=1000, stress=0,
+             checkSave=0):
+    # play a game for every seed spread over a pool of processes, and sum
+    # up how far the games got
+    run = functools.partial(runBot, bot=bot, limit=limit, stress=stress,
+                            checkSave=checkSave, size=(mapw, maph))
+    with ProcessPoolExecutor(jobs) as pool:
+        results = list(pool.map(run, seeds))
+    return summarize(results)
+
+def summarize(results):
+    ends = {}
+    for r in results:
+        ends[r["result"]] = ends.get(r["result"], 0)+1
+    levels = []
+    for l in range(1, max([r["level"] for r in results], default=0)+1):
+        reached = sum([1 for r in results if r["level"] >= l])
+        died = sum([1 for r in results \
+                    if r["level"] == l and r["result"] == "dead"])
+        levels.append({"level": l, "reached": reached, "died": died,
+                       "survival": 1-died/reached if reached else 0})
+    turns = sorted([r["turns"] for r in results])
+    n = len(turns)
+    summary = {"games": n, "ends": ends, "levels": levels,
+               "turns": {"mean": sum(turns)/n if n else 0,
+                         "median": turns[n//2] if n else 0,
+                         "min": turns[0] if n else 0,
+                         "max": turns[-1] if n else 0}}
+    checked = [r for r in results if "saveCheck" in r]
+    if len(checked) != 0:
+        summary["saveCheck"] = {"games": len(checked),
+                                "diverged": [r["seed"] for r in checked \
+                                             if not r["saveCheck"]]}
+    return summary
+
+# profiling: with it on, the functions in profiledNames and the Actor
+# methods in profiledMethods are swapped for wrappers that count calls and
+# time spent (calls they make included), and Game.step times commands
+# with it off the plain functions are back in place, so nothing is counted
+profiling = False
+profiledNames = ["generateMap", "pathMap", "astarMap", "findPath",
+                 "buildRegions", "regionField", "regionPath", "getFov",
+                 "castFov", "sees", "updateExplored", "closestUnexplored",
+                 "describe", "explore", "rest", "target", "update",
+                 "runTurn"]
+profiledMethods = ["enemyUpdate", "chase", "wander", "wake"]
+# [calls, seconds] by function and [count, seconds, slowest] by command
+funcStats = {}
+commandStats = {}
+unprofiled = {}
+commandNames = ["north", "east", "south", "west", "up", "down", "wait",
+                "quit", "help", "look", "explore", "rest", "save", "stats",
+                "go"]
+
+def timedCall(name, f):
+    c = funcStats.setdefault(name, [0, 0.0])
+    def call(*args, **kwargs):
+        t = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            c[0] += 1
+            c[1] += time.perf_counter()-t
+    return call
+
+def setProfiling(on):
+    global profiling
+    if on == profiling:
+        return
+    profiling = on
+    g = globals()
+    for name in profiledNames:
+        if on:
+            unprofiled[name] = g[name]
+            g[name] = timedCall(name, g[name])
+        else:
+            g[name] = unprofiled[name]
+    for name in profiledMethods:
+        key = "Actor."+name
+        if on:
+            unprofiled[key] = getattr(Actor, name)
+            setattr(Actor, name, timedCall(key, unprofiled[key]))
+        else:
+            setattr(Actor, name, unprofiled[key])
+
+def resetStats():
+    for c in funcStats.values():
+        c[0] = 0
+        c[1] = 0.0
+    commandStats.clear()
+
+def commandName(text):
+    # full name of the command, as command() would read it
+    word = text.strip().lower().split(" ")[0]
+    for n in commandNames:
+        if word != "" and n.startswith(word):
+            return n
+    return "other"
+
+def countCommand(text, t):
+    c = commandStats.setdefault(commandName(text), [0, 0.0, 0.0])
+    c[0] += 1
+    c[1] += t
+    c[2] = max(c[2], t)
+
+def statsReport():
+    lines = ["{:22}{:>9}{:>11}{:>10}".format \
+             ("function", "calls", "total ms", "us/call")]
+    for name, c in sorted(funcStats.items(), key=lambda i: -i[1][1]):
+        if c[0] != 0:
+            lines.append("{:22}{:>9}{:>11.1f}{:>10.1f}".format \
+                         (name, c[0], c[1]*1000, c[1]*1e6/c[0]))
+    lines.append("{:22}{:>9}{:>11}{:>10}".format \
+                 ("command", "count", "total ms", "max ms"))
+    for name, c in sorted(commandStats.items(), key=lambda i: -i[1][1]):
+        lines.append("{:22}{:>9}{:>11.1f}{:>10.1f}".format \
+                     (name, c[0], c[1]*1000, c[2]*1000))
+    return lines
+
+def dumpStats(path):
+    with open(path, "w") as f:
+        json.dump({"functions": funcStats, "commands": commandStats}, f,
+                  indent=1)
+
+# TEXTROGUE_PROFILE=1 turns profiling on from the start, any other value
+# is a file the counters are written to as json on exit
+if os.environ.get("TEXTROGUE_PROFILE", "") != "":
+    setProfiling(True)
+    if os.environ["TEXTROGUE_PROFILE"] != "1":
+        atexit.register(dumpStats, os.environ["TEXTROGUE_PROFILE"])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="simple text roguelike")
+    parser.add_argument("--stress", type=int, default=0, metavar="N",
+                        help="put N extra monsters on every level")
+    parser.add_argument("--size", type=mapSize, default=(mapw, maph),
+                        metavar="WxH",
+                        help="map size, {}x{} by default".format(mapw, maph))
+    parser.add_argument("--batch", metavar="FILE",
+                        help="run the commands in FILE (- for stdin) and "
+                             "print the result as json")
+    parser.add_argument("--seed", type=int,
+                        help="seed for the game's random numbers")
+    parser.add_argument("--brief", action="store_true",
+                        help="leave out descriptions of the surroundings")
+    parser.add_argument("--sim", type=int, metavar="N",
+                        help="play N games with a bot, one for each seed "
+                             "from --seed on, and print a summary as json")
+    parser.add_argument("--bot", choices=sorted(bots), default="explorer",
+                        help="bot that plays the --sim games")
+    parser.add_argument("--jobs", type=int,
+                        help="processes for --sim, one per core by default")
+    parser.add_argument("--limit", type=int, default=1000, metavar="N",
+                        help="commands before a --sim game is cut short")
+    parser.add_argument("--check-save", type=int, default=0, metavar="N",
+                        help="save each --sim game after N commands and "
+                             "check a copy loaded from the save plays the "
+                             "same, exits with 1 if one doesn't")
+    parser.add_argument("--load", metavar="FILE",
+                        help="carry on with a game saved with \"save\"")
+    parser.add_argument("--autosave", metavar="FILE",
+                        help="save to FILE every time the stairs are taken")
+    parser.add_argument("--log", metavar="FILE",
+                        help="write every command to FILE for --replay, "
+                             "textrogue-SEED.log when playing by default")
+    parser.add_argument("--no-log", action="store_true",
+                        help="don't write a replay log")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="rerun the game in a replay log and print the "
+                             "result as json")
+    parser.add_argument("--until", type=int, default=-1, metavar="N",
+                        help="stop the --replay at turn N, part way through "
+                             "a command if need be")
+    parser.add_argument("--play", action="store_true",
+                        help="carry on playing where the --replay stops")
+    args = parser.parse_args()
+    stressMonsters = args.stress
+    mapw, maph = args.size
+    log = args.log
+    if args.no_log:
+        log = None
+    # interactive games log to a file named after their seed unless told
+    # otherwise, see logName
+    named = log == None and not args.no_log
+    if args.replay != None:
+        game, head, n = replay(args.replay, args.until)
+        if args.play:
+            if named:
+                log = logName(head["seed"])
+                print("Replay log: {}".format(log))
+            if log != None:
+                # the new log starts with what was replayed, so it can be
+                # replayed in turn, with the last command cut where the
+                # replay stopped
+                with open(args.replay) as f:
+                    lines = [f.readline() for i in range(n+1)][1:]
+                cuts = {c[0]: c[1] for c in head.get("cuts", [])}
+                if args.until >= 0 and n != 0 and \
+                        (not n-1 in cuts or args.until < cuts[n-1]):
+                    cuts[n-1] = args.until
+                if len(cuts) != 0:
+                    head["cuts"] = sorted([list(c) for c in cuts.items()])
+                game.log = open(log, "w", buffering=1)
+                game.log.write(json.dumps(head)+"\n")
+                game.log.writelines(lines)
+            quiet = args.brief
+            describe(player.x, player.y)
+            for l in game.events():
+                print(l)
+            play(game)
+        else:
+            r = game.result()
+            game.close()
+            if r["result"] == None:
+                r["result"] = "eof"
+            r["commands"] = n
+            print(json.dumps(r))
+    elif args.sim != None:
+        first = args.seed if args.seed != None else 0
+        summary = simulate(range(first, first+args.sim), args.bot, \
+                           args.jobs, args.limit, args.stress, args.check_save)
+        print(json.dumps(summary))
+        if len(summary.get("saveCheck", {"diverged": []})["diverged"]) != 0:
+            sys.exit(1)
+    elif args.batch == None:
+        seed = args.seed
+        if named:
+            # picked here rather than by Game so the log can be named
+            if seed == None:
+                seed = random.randrange(2**32)
+            log = logName(seed)
+            print("Replay log: {}".format(log))
+        game = Game(seed, args.brief, args.load, args.autosave, log)
+        for l in game.intro:
+            print(l)
+        play(game)
+    elif args.batch == "-":
+        print(json.dumps(batch(sys.stdin, args.seed, args.brief, log)))
+    else:
+        with open(args.batch) as f:
+            print(json.dumps(batch(f, args.seed, args.brief, log)))